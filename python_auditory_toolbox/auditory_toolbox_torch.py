@@ -1,11 +1,18 @@
 """A PyTorch port of portions of the Matlab Auditory Toolbox.
 """
+import functools
 import math
 from typing import List, Optional, Tuple
 import torch
 from torch import nn
 from torchaudio.functional import lfilter
 
+try:
+  import triton
+  import triton.language as tl
+except ImportError:
+  triton = None
+
 
 class ErbFilterBank(nn.Module):
   """Applies an Auditory Filterbank to data of dimension of `(..., time)` as
@@ -23,12 +30,31 @@ class ErbFilterBank(nn.Module):
       Sampling rate (in Hz) of the filterbank (needed to determine CFs).
       Default: 16000
     dtype: (Optional) 
-      Cast coefficients to dtype after instantiation. Default: None
+      Cast coefficients to dtype after instantiation. The filters are
+      designed in double precision; with e.g. torch.float32 the filtering
+      then runs in single precision, halving the memory traffic.
+      Default: None
+    mode : str
+      One of 'iir', 'fft' or 'fir'. The 'iir' mode runs the cascade of
+      biquads with `lfilter`. In 'fft' mode the input is convolved with the
+      (truncated) impulse response of each channel using FFT-based
+      overlap-add, which avoids the sample-by-sample recursion of the IIR
+      filters and is much faster on GPU. The 'fir' mode computes the same
+      convolution directly with `conv1d`, which needs no FFT workspace and
+      is faster for short inputs. Default: 'iir'
+      On CUDA, the 'iir' mode uses a Triton kernel (when Triton is
+      installed) only if both the input and the filterbank are single
+      precision, i.e. with `dtype=torch.float32` or after
+      `.to(torch.float32)`. The default double precision filterbank always
+      uses `lfilter`.
 
   .. note::
       The implementation does not attempt to account for filtering delays.
       Note also that uniform temporal sampling is assumed and that the data
       are not mean-centered or zero-padded prior to filtering.
+      In 'fft' and 'fir' modes the impulse responses are truncated after
+      30 time constants of the slowest decaying channel, e.g. 2113 samples
+      at 16 kHz with a lowest frequency of 100 Hz.
 
   Examples:
       >>> fbank = ErbFilterBank(sampling_rate=16000)
@@ -40,8 +66,11 @@ class ErbFilterBank(nn.Module):
   Attributes:
       fcoefs: Filter coefficients generated by make_erb_filters
       sos: Coefficients used for subsequent filtering.
+      impulse_response: Truncated impulse response of each channel, of size
+        (num_channels, ir_length), used in 'fft' and 'fir' modes.
   """
-  __constants__ = ['sampling_rate', 'num_channels', 'lowest_frequency']
+  __constants__ = ['sampling_rate', 'num_channels', 'lowest_frequency',
+                   'mode', 'ir_length', 'fft_size']
 
   def __init__(
           self,
@@ -49,25 +78,42 @@ class ErbFilterBank(nn.Module):
           num_channels: int = 64,
           lowest_frequency: float = 100.,
           dtype: Optional[torch.dtype] = None,
+          mode: str = 'iir',
   ) -> None:
     super().__init__()
     if sampling_rate <= 0:
       raise ValueError('Sampling rate cannoy be negative or zero')
     if lowest_frequency <= 0 or lowest_frequency >= sampling_rate/2:
       raise ValueError('Misspecified lowest frequency')
+    if mode not in ['fft', 'fir', 'iir']:
+      raise ValueError('Mode should be one of \'fft\', \'fir\' or \'iir\'')
 
     self.sampling_rate = sampling_rate
     self.num_channels = num_channels
     self.lowest_frequency = lowest_frequency
-    self.fcoefs = make_erb_filters(self.sampling_rate,
-                                   self.num_channels,
-                                   self.lowest_frequency)
+    self.mode = mode
+
+    # The design is cached and shared between instances: copy it, so that
+    # in-place changes (e.g. load_state_dict) do not leak into the cache.
+    fcoefs, sos, impulse_response = _design_erb_filterbank(
+        self.sampling_rate, self.num_channels, self.lowest_frequency)
+    self.ir_length = impulse_response.shape[-1]
+    # Block size used for the overlap-add: each block of fft_size-ir_length+1
+    # input samples is convolved at once.
+    self.fft_size = int(2**(math.ceil(math.log2(2*self.ir_length))))
+    self.fcoefs = [c.clone() for c in fcoefs]
+    sos = sos.clone()
+    impulse_response = impulse_response.clone()
+
     if dtype:
-      sos = prepare_coefficients(self.fcoefs).to(dtype=dtype)
-    else:
-      sos = prepare_coefficients(self.fcoefs)
+      self.fcoefs = [c.to(dtype=dtype) for c in self.fcoefs]
+      sos = sos.to(dtype=dtype)
+      impulse_response = impulse_response.to(dtype=dtype)
 
     self.register_buffer('sos', sos)
+    # Derived from the constructor arguments: not part of the state dict.
+    self.register_buffer('impulse_response', impulse_response,
+                         persistent=False)
 
   def forward(self, x: torch.Tensor) -> torch.Tensor:
     """Pass audio through the set of filters.
@@ -91,21 +137,227 @@ class ErbFilterBank(nn.Module):
       raise TypeError('The input tensor should have size `(..., time)`')
     if x.shape[-1] <= 1:
       raise TypeError('The input tensor should have size `(..., time)`')
-    new_dims = [1 for j in list(x.unsqueeze(-2).shape)]
-    new_dims[-2] = self.num_channels
 
-    y = lfilter(x.unsqueeze(-2).tile(new_dims),
-                self.sos[..., -1],
-                self.sos[..., 0],
+    if self.mode == 'iir':
+      return _iir_filterbank(x, self.sos)
+    if self.mode == 'fir':
+      return _fir_filterbank(x, self.impulse_response)
+
+    return _fft_filterbank(x, self.impulse_response, self.fft_size)
+
+
+@functools.lru_cache(maxsize=16)
+def _design_erb_filterbank(sampling_rate: float, num_channels: int,
+                           lowest_frequency: float,
+                           ) -> Tuple[List[torch.Tensor], torch.Tensor,
+                                      torch.Tensor]:
+  """Design (in double precision) the filters of an ErbFilterBank.
+
+  Returns the make_erb_filters coefficients, the reassembled sos and the
+  (num_channels, ir_length) impulse responses. Results are cached, so they
+  must not be modified in place.
+  """
+  fcoefs = make_erb_filters(sampling_rate, num_channels, lowest_frequency)
+  sos = prepare_coefficients(fcoefs)
+
+  # The envelope of a Gammatone channel decays as exp(-b*t), where b is set by
+  # the channel's bandwidth. The pole radius of the channel is exp(-b/fs) and
+  # sos[:, 2, 4] = exp(-2*b/fs). Keep ir_decay time constants of the slowest
+  # channel, which leaves a tail with less than 1e-18 of the energy.
+  ir_decay = 30
+  decay_per_sample = -math.log(float(torch.max(sos[:, 2, 4])))/2
+  ir_length = int(math.ceil(ir_decay/decay_per_sample))
+
+  impulse = torch.zeros(1, ir_length, dtype=sos.dtype)
+  impulse[0, 0] = 1.
+  impulse_response = _iir_filterbank(impulse, sos)[0]
+  return fcoefs, sos, impulse_response
+
+
+def _iir_filterbank(x: torch.Tensor, sos: torch.Tensor) -> torch.Tensor:
+  """Filter (..., time) data with the cascade of biquads described by sos.
+
+  The four biquads are applied one by one. They all share the same pole pair,
+  close to the unit circle, so fusing them into higher order sections loses
+  precision (or stability) quickly as the sampling rate goes up.
+
+  On CUDA, single precision data is filtered with a Triton kernel when
+  Triton is installed.
+
+  Returns a tensor of size (..., num_channels, time).
+  """
+  if (triton is not None and x.is_cuda and x.dtype == torch.float32 and
+      sos.dtype == torch.float32):
+    return _biquad_cascade_cuda(x, sos)
+
+  # A broadcast view: lfilter pads (and thereby copies) its input anyway.
+  # Passing x with batching=False instead would make lfilter stack one copy
+  # of x per channel before padding it.
+  y = x.unsqueeze(-2).expand(*x.shape[:-1], sos.shape[0], x.shape[-1])
+
+  for j in range(4):
+    y = lfilter(y,
+                sos[..., -1],
+                sos[..., j],
                 clamp=False, batching=True)
 
-    for j in range(3):
-      y = lfilter(y,
-                  self.sos[..., -1],
-                  self.sos[..., j+1],
-                  clamp=False, batching=True)
+  return y
+
+
+if triton is not None:
+  @triton.jit
+  def _biquad(x, b0, b1, b2, a1, a2, z1, z2):
+    """One step of a biquad in transposed direct form II."""
+    y = b0*x + z1
+    z1 = b1*x - a1*y + z2
+    z2 = b2*x - a2*y
+    return y, z1, z2
+
+  @triton.jit
+  def _biquad_cascade_kernel(x_ptr, coefs_ptr, y_ptr, num_channels,
+                             sample_len, input_per_channel: tl.constexpr):
+    """Filter one (batch, channel) row through its four biquads.
+
+    coefs holds (b0, b1, b2, a1, a2) for each of the four sections of a
+    channel, i.e. it is of size (num_channels, 20).
+    """
+    # 64-bit offsets: batch*num_channels*time may exceed 2**31.
+    row = tl.program_id(0).to(tl.int64)
+    channel = row % num_channels
+    if input_per_channel:
+      x_row = x_ptr + row*sample_len
+    else:
+      x_row = x_ptr + (row // num_channels)*sample_len
+    y_row = y_ptr + row*sample_len
+
+    c = coefs_ptr + channel*20
+    b00, b01, b02 = tl.load(c + 0), tl.load(c + 1), tl.load(c + 2)
+    a01, a02 = tl.load(c + 3), tl.load(c + 4)
+    b10, b11, b12 = tl.load(c + 5), tl.load(c + 6), tl.load(c + 7)
+    a11, a12 = tl.load(c + 8), tl.load(c + 9)
+    b20, b21, b22 = tl.load(c + 10), tl.load(c + 11), tl.load(c + 12)
+    a21, a22 = tl.load(c + 13), tl.load(c + 14)
+    b30, b31, b32 = tl.load(c + 15), tl.load(c + 16), tl.load(c + 17)
+    a31, a32 = tl.load(c + 18), tl.load(c + 19)
+
+    z01, z02, z11, z12 = 0., 0., 0., 0.
+    z21, z22, z31, z32 = 0., 0., 0., 0.
+    for t in range(0, sample_len):
+      v = tl.load(x_row + t)
+      v, z01, z02 = _biquad(v, b00, b01, b02, a01, a02, z01, z02)
+      v, z11, z12 = _biquad(v, b10, b11, b12, a11, a12, z11, z12)
+      v, z21, z22 = _biquad(v, b20, b21, b22, a21, a22, z21, z22)
+      v, z31, z32 = _biquad(v, b30, b31, b32, a31, a32, z31, z32)
+      tl.store(y_row + t, v)
+
+
+def _launch_biquad_cascade(x: torch.Tensor, coefs: torch.Tensor,
+                           num_batches: int,
+                           input_per_channel: bool) -> torch.Tensor:
+  """Run the Triton kernel on contiguous (num_batches, [C,] time) data."""
+  num_channels = coefs.shape[0]
+  sample_len = x.shape[-1]
+  y = torch.empty(num_batches, num_channels, sample_len,
+                  dtype=x.dtype, device=x.device)
+  # Each program runs a serial scalar recursion: a single warp is enough.
+  _biquad_cascade_kernel[(num_batches*num_channels,)](
+      x, coefs, y, num_channels, sample_len,
+      input_per_channel=input_per_channel, num_warps=1)
+  return y
+
+
+class _BiquadCascade(torch.autograd.Function):
+  """Differentiable (w.r.t. the input) Triton biquad cascade."""
+
+  @staticmethod
+  def forward(ctx, x, coefs):  # pylint: disable=arguments-differ
+    ctx.save_for_backward(coefs)
+    return _launch_biquad_cascade(x, coefs, x.shape[0], False)
+
+  @staticmethod
+  def backward(ctx, grad_y):  # pylint: disable=arguments-differ
+    # The adjoint of a causal filter is the same filter run backwards in
+    # time, summed over the channels that share the input.
+    coefs, = ctx.saved_tensors
+    grad_x = _launch_biquad_cascade(grad_y.flip(-1).contiguous(), coefs,
+                                    grad_y.shape[0], True)
+    return grad_x.flip(-1).sum(dim=-2), None
+
 
-    return y
+def _biquad_cascade_cuda(x: torch.Tensor, sos: torch.Tensor) -> torch.Tensor:
+  """Filter (..., time) CUDA data with the Triton biquad cascade.
+
+  Returns a tensor of size (..., num_channels, time).
+  """
+  num_channels = sos.shape[0]
+  # (num_channels, 4 sections, (b0, b1, b2, a1, a2)). The leading denominator
+  # coefficient is always 1.
+  coefs = torch.cat([sos[:, :, :4].transpose(1, 2),
+                     sos[:, 1:, 4].unsqueeze(1).expand(num_channels, 4, 2)],
+                    dim=-1).reshape(num_channels, 20).contiguous()
+  y = _BiquadCascade.apply(x.reshape(-1, x.shape[-1]).contiguous(), coefs)
+  return y.reshape(*x.shape[:-1], num_channels, x.shape[-1])
+
+
+def _poly_mul(p: torch.Tensor, q: torch.Tensor) -> torch.Tensor:
+  """Multiply (num_channels, n) and (num_channels, m) polynomial coefficients.
+  """
+  r = torch.zeros(p.shape[0], p.shape[1]+q.shape[1]-1, dtype=p.dtype,
+                  device=p.device)
+  for i in range(p.shape[1]):
+    r[:, i:i+q.shape[1]] += p[:, i:i+1] * q
+  return r
+
+
+def _fir_filterbank(x: torch.Tensor,
+                    impulse_response: torch.Tensor) -> torch.Tensor:
+  """Convolve (..., time) data with (num_channels, ir_length) FIR filters.
+
+  The convolution is computed directly with a single `conv1d`. Returns a
+  tensor of size (..., num_channels, time).
+  """
+  num_channels, ir_length = impulse_response.shape
+  sample_len = x.shape[-1]
+  # conv1d computes a cross-correlation: flip the filters, and pad on the
+  # left only to keep the output causal.
+  y = torch.nn.functional.conv1d(
+      torch.nn.functional.pad(x.reshape(-1, 1, sample_len), (ir_length-1, 0)),
+      impulse_response.flip(-1).unsqueeze(1))
+  return y.reshape(*x.shape[:-1], num_channels, sample_len)
+
+
+def _fft_filterbank(x: torch.Tensor, impulse_response: torch.Tensor,
+                    fft_size: int) -> torch.Tensor:
+  """Convolve (..., time) data with (num_channels, ir_length) FIR filters.
+
+  The convolution is computed with FFTs, using overlap-add on blocks of
+  fft_size-ir_length+1 samples. Returns a tensor of size
+  (..., num_channels, time), cropped to the length of the input.
+  """
+  sample_len = x.shape[-1]
+  ir_length = impulse_response.shape[-1]
+  block_len = fft_size - ir_length + 1
+  num_blocks = int(math.ceil(sample_len/block_len))
+
+  x = torch.nn.functional.pad(x, (0, num_blocks*block_len - sample_len))
+  x = x.reshape(*x.shape[:-1], num_blocks, block_len)
+
+  # pylint: disable=not-callable
+  h_fft = torch.fft.rfft(impulse_response, n=fft_size, dim=-1)
+  # pylint: disable=not-callable
+  x_fft = torch.fft.rfft(x, n=fft_size, dim=-1)
+  # (..., num_blocks, num_channels, fft_size)
+  # pylint: disable=not-callable
+  y = torch.fft.irfft(x_fft.unsqueeze(-2) * h_fft, n=fft_size, dim=-1)
+
+  # Overlap-add: the tail of each block spills into the next one. The tail
+  # (ir_length-1 samples) is never longer than a block.
+  out = y[..., :block_len].clone()
+  out[..., 1:, :, :ir_length-1] += y[..., :-1, :, block_len:]
+
+  out = out.transpose(-2, -3)
+  out = out.reshape(*out.shape[:-2], num_blocks*block_len)
+  return out[..., :sample_len]
 
 
 def erb_space(low_freq: float = 100,
@@ -146,15 +398,19 @@ def erb_space(low_freq: float = 100,
   # All of the follow_freqing expressions are derived in Apple TR #35, "An
   # Efficient Implementation of the Patterson-Holdsworth Cochlear
   # Filter Bank."  See pages 33-34.
-  cf_array = (-(ear_q*min_bw) + torch.exp(
-      torch.arange(1, 1+n, dtype=torch.float64).unsqueeze(1) *
-      (-math.log(high_freq + ear_q*min_bw) +
-       math.log(low_freq + ear_q*min_bw))/n) * (high_freq + ear_q*min_bw))
+  # The (shifted) frequencies are log-spaced from high_freq down to
+  # low_freq; the first point (high_freq itself) is dropped.
+  cf_array = torch.logspace(math.log(high_freq + ear_q*min_bw),
+                            math.log(low_freq + ear_q*min_bw),
+                            n+1, base=math.e, dtype=torch.float64)[1:]
+  cf_array = cf_array.unsqueeze(1) - ear_q*min_bw
   return cf_array
 
 
 def make_erb_filters(fs: float, num_channels: int,
-                     low_freq: float) -> List[torch.Tensor]:
+                     low_freq: float,
+                     dtype: torch.dtype = torch.float64,
+                     ) -> List[torch.Tensor]:
   """Compute filter coefficients for a bank of Gammatone filters.
 
   The code is directly adapted from: 'Auditory Toolbox - An Efficient
@@ -175,6 +431,10 @@ def make_erb_filters(fs: float, num_channels: int,
     How many channels in the filterbank.
   low_freq : float
     The lowest center frequency of the filterbank.
+  dtype : torch.dtype, optional
+    The dtype of the returned coefficients. The design itself is always
+    carried out in double precision and only the results are cast.
+    The default is torch.float64.
 
   Returns
   -------
@@ -188,6 +448,57 @@ def make_erb_filters(fs: float, num_channels: int,
   else:
     cf = num_channels
 
+  fcoefs = _erb_filter_coefficients(cf, t)
+
+  return [c.to(dtype=dtype) for c in fcoefs]
+
+
+def make_erb_filters_batched(fs_list: List[float], num_channels: int,
+                             low_freq_list: List[float],
+                             dtype: torch.dtype = torch.float64,
+                             ) -> torch.Tensor:
+  """Compute the reassembled coefficients of several Gammatone filterbanks.
+
+  The coefficients of all filterbanks are designed in a single vectorized
+  pass, stacking the center frequencies along a leading axis.
+
+  Parameters
+  ----------
+  fs_list : List[float]
+    Sampling rate (in Hz) of each filterbank.
+  num_channels : int
+    How many channels in each filterbank.
+  low_freq_list : List[float]
+    The lowest center frequency of each filterbank.
+  dtype : torch.dtype, optional
+    The dtype of the returned coefficients. The default is torch.float64.
+
+  Returns
+  -------
+  sos : torch.Tensor
+    A (num_banks x num_channels x 3 x 5) tensor, where sos[i] is equal to
+    prepare_coefficients(make_erb_filters(fs_list[i], num_channels,
+    low_freq_list[i])).
+
+  """
+  if len(fs_list) != len(low_freq_list):
+    raise ValueError('fs_list and low_freq_list should have the same length')
+  cf = torch.stack([erb_space(low_freq, fs/2, num_channels)
+                    for fs, low_freq in zip(fs_list, low_freq_list)])
+  t = 1/torch.tensor(fs_list, dtype=torch.float64).reshape(-1, 1, 1)
+
+  fcoefs = _erb_filter_coefficients(cf, t)
+
+  return prepare_coefficients(fcoefs, dtype=dtype)
+
+
+def _erb_filter_coefficients(cf: torch.Tensor, t) -> List[torch.Tensor]:
+  """Compute the make_erb_filters coefficients for center frequencies cf.
+
+  The sampling interval t is either a float or a tensor that broadcasts
+  against cf, e.g. of size (num_banks x 1 x 1) for cf of size
+  (num_banks x num_channels x 1).
+  """
   # Change the follow_freqing three parameters if you wish to use a different
   # erb scale.  Must change in ErbSpace too.
   ear_q = 9.26449				#  Glasberg and Moore Parameters
@@ -198,45 +509,40 @@ def make_erb_filters(fs: float, num_channels: int,
 
   b = 1.019*2*math.pi*erb
 
-  a11 = -(2 * t * torch.cos(2 * cf * math.pi * t) / torch.exp(b * t) + 2 *
-         math.sqrt(3 + 2**1.5) * t * torch.sin(2 * cf * math.pi * t) /
-         torch.exp(b * t)) / 2
-  a12 = -(2 * t * torch.cos(2 * cf * math.pi * t) / torch.exp(b * t) - 2 *
-         math.sqrt(3 + 2**1.5) * t * torch.sin(2 * cf * math.pi * t) /
-         torch.exp(b * t)) / 2
-  a13 = -(2 * t * torch.cos(2 * cf * math.pi * t) / torch.exp(b * t) + 2 *
-         math.sqrt(3 - 2**1.5) * t * torch.sin(2 * cf * math.pi * t) /
-         torch.exp(b * t)) / 2
-  a14 = -(2 * t * torch.cos(2 * cf * math.pi * t) / torch.exp(b * t) - 2 *
-         math.sqrt(3 - 2**1.5) * t * torch.sin(2 * cf * math.pi * t) /
-         torch.exp(b * t)) / 2
-
-  gain = torch.abs((-2*torch.exp(4*complex(0, 1)*cf*math.pi*t)*t +
-                    2*torch.exp(-(b*t) + 2*complex(0, 1)*cf*math.pi*t)*t *
-                    (torch.cos(2*cf*math.pi*t) - math.sqrt(3 - 2**(3/2)) *
-                     torch.sin(2*cf*math.pi*t))) *
-                   (-2*torch.exp(4*complex(0, 1)*cf*math.pi*t)*t +
-                    2*torch.exp(-(b*t) + 2*complex(0, 1)*cf*math.pi*t)*t *
-                    (torch.cos(2*cf*math.pi*t) + math.sqrt(3 - 2**(3/2)) *
-                       torch.sin(2*cf*math.pi*t))) *
-                   (-2*torch.exp(4*complex(0, 1)*cf*math.pi*t)*t +
-                    2*torch.exp(-(b*t) + 2*complex(0, 1)*cf*math.pi*t)*t *
-                    (torch.cos(2*cf*math.pi*t) -
-                       math.sqrt(3 + 2**(3/2))*torch.sin(2*cf*math.pi*t))) *
-                   (-2*torch.exp(4*complex(0, 1)*cf*math.pi*t)*t +
-                    2*torch.exp(-(b*t) + 2*complex(0, 1)*cf*math.pi*t)*t *
-                    (torch.cos(2*cf*math.pi*t) +
-                     math.sqrt(3 + 2**(3/2))*torch.sin(2*cf*math.pi*t))) /
-                   (-2 / torch.exp(2*b*t) -
-                    2*torch.exp(4*complex(0, 1)*cf*math.pi*t) +
-                    2*(1 + torch.exp(4*complex(0, 1)*cf*math.pi*t)) /
-                    torch.exp(b*t))**4)
-
-  fcoefs = [t * torch.ones(len(cf), 1, dtype=torch.float64),
+  # Terms shared by the coefficient expressions below.
+  cos_w = torch.cos(2*cf*math.pi*t)
+  sin_w = torch.sin(2*cf*math.pi*t)
+  exp_bt = torch.exp(b*t)
+  # Complex exponentials of the gain, with jw = 2j*pi*cf*t.
+  jw = 2j*math.pi*cf*t
+  exp_2jw = torch.exp(2*jw)
+  exp_jw_bt = torch.exp(-(b*t) + jw)
+
+  a11 = -(2 * t * cos_w / exp_bt + 2 *
+         math.sqrt(3 + 2**1.5) * t * sin_w / exp_bt) / 2
+  a12 = -(2 * t * cos_w / exp_bt - 2 *
+         math.sqrt(3 + 2**1.5) * t * sin_w / exp_bt) / 2
+  a13 = -(2 * t * cos_w / exp_bt + 2 *
+         math.sqrt(3 - 2**1.5) * t * sin_w / exp_bt) / 2
+  a14 = -(2 * t * cos_w / exp_bt - 2 *
+         math.sqrt(3 - 2**1.5) * t * sin_w / exp_bt) / 2
+
+  gain = torch.abs((-2*exp_2jw*t + 2*exp_jw_bt*t *
+                    (cos_w - math.sqrt(3 - 2**(3/2)) * sin_w)) *
+                   (-2*exp_2jw*t + 2*exp_jw_bt*t *
+                    (cos_w + math.sqrt(3 - 2**(3/2)) * sin_w)) *
+                   (-2*exp_2jw*t + 2*exp_jw_bt*t *
+                    (cos_w - math.sqrt(3 + 2**(3/2)) * sin_w)) *
+                   (-2*exp_2jw*t + 2*exp_jw_bt*t *
+                    (cos_w + math.sqrt(3 + 2**(3/2)) * sin_w)) /
+                   (-2 / torch.exp(2*b*t) - 2*exp_2jw +
+                    2*(1 + exp_2jw) / exp_bt)**4)
+
+  fcoefs = [t * torch.ones_like(cf, dtype=torch.float64),
             a11, a12, a13, a14,
-            0 * torch.ones(len(cf), 1, dtype=torch.float64),
-            1 * torch.ones(len(cf), 1, dtype=torch.float64),
-            -2*torch.cos(2*cf*math.pi*t)/torch.exp(b*t),
+            torch.zeros_like(cf, dtype=torch.float64),
+            torch.ones_like(cf, dtype=torch.float64),
+            -2*cos_w/exp_bt,
             torch.exp(-2*b*t),
             gain]
 
@@ -245,36 +551,52 @@ def make_erb_filters(fs: float, num_channels: int,
 
 
 
-def prepare_coefficients(fcoefs: List[torch.Tensor]) -> torch.Tensor:
+def prepare_coefficients(fcoefs: List[torch.Tensor],
+                         dtype: Optional[torch.dtype] = None,
+                         ) -> torch.Tensor:
   r"""Reassemble filter coefficients to realize filters.
 
   Parameters
   ----------
   fcoefs : List[torch.Tensor]
-      Coefficients prepared by make_erb_filters. 
+      Coefficients prepared by make_erb_filters, of size (num_channels x 1)
+      or (..., num_channels x 1).
+  dtype : Optional[torch.dtype], optional
+      Cast the reassembled coefficients to dtype. The default (None) keeps
+      the dtype of fcoefs.
 
   Returns
   -------
   sos : torch.Tensor
-      Reassembled coefficients.
+      Reassembled coefficients, of size (..., num_channels x 3 x 5).
 
   """
   [a0, a11, a12, a13, a14, a2, b0, b1, b2, gain] = fcoefs
-  n_chan = a0.shape[0]
-  assert n_chan == a11.shape[0]
-  assert n_chan == a12.shape[0]
-  assert n_chan == a13.shape[0]
-  assert n_chan == a14.shape[0]
-  assert n_chan == b0.shape[0]
-  assert n_chan == b1.shape[0]
-  assert n_chan == gain.shape[0]
-
-  sos = torch.cat([
-      torch.cat([a0/gain,  a0,   a0, a0, b0], dim=1).unsqueeze(1),
-      torch.cat([a11/gain, a12, a13, a14, b1], dim=1).unsqueeze(1),
-      torch.cat([a2/gain,  a2,   a2, a2, b2], dim=1).unsqueeze(1),
-  ], dim=1)
-
+  n_chan = a0.shape[:-1]
+  assert n_chan == a11.shape[:-1]
+  assert n_chan == a12.shape[:-1]
+  assert n_chan == a13.shape[:-1]
+  assert n_chan == a14.shape[:-1]
+  assert n_chan == b0.shape[:-1]
+  assert n_chan == b1.shape[:-1]
+  assert n_chan == gain.shape[:-1]
+
+  # sos[..., j] holds the numerator of the j-th biquad (the first one
+  # normalized by the gain), sos[..., 4] their common denominator.
+  sos = torch.empty((*n_chan, 3, 5), dtype=a0.dtype, device=a0.device)
+  sos[..., 0, :4] = a0
+  sos[..., 1, 0:1] = a11
+  sos[..., 1, 1:2] = a12
+  sos[..., 1, 2:3] = a13
+  sos[..., 1, 3:4] = a14
+  sos[..., 2, :4] = a2
+  sos[..., 0] /= gain
+  sos[..., 0, 4:] = b0
+  sos[..., 1, 4:] = b1
+  sos[..., 2, 4:] = b2
+
+  if dtype:
+    sos = sos.to(dtype=dtype)
   return sos
 
 
@@ -355,12 +677,12 @@ def make_vowel(sample_len: int,
     points = torch.sort(torch.as_tensor(pitch, dtype=torch.float64))[0]
     points = points[points < sample_len-1]
 
-  indices = torch.floor(points).to(torch.int16)
+  indices = torch.floor(points).long()
 
   #  Use a triangular approximation to an impulse function.  The important
   #  part is to keep the total amplitude the same.
-  y[(indices).tolist()] = (indices+1)-points
-  y[(indices+1).tolist()] = points-indices
+  y.scatter_add_(0, indices, (indices+1).to(y.dtype)-points)
+  y.scatter_add_(0, indices+1, points-indices.to(y.dtype))
 
   # GlottalFilter(x,fs) - Filter an impulse train and simulate the glottal
   # transfer function.  The sampling interval (sample_rate) is given in Hz.
@@ -372,14 +694,18 @@ def make_vowel(sample_len: int,
   #    formant in a speech signal.  The formant frequency (in Hz) is given
   #    by f and the bandwidth of the formant is a constant 50Hz.  The
   #    sampling frequency in Hz is given by fs.
-  if f1 > 0:
-    y = formant_filter(f1, sample_rate, y, bw)
-
-  if f2 > 0:
-    y = formant_filter(f2, sample_rate, y, bw)
-
-  if f3 > 0:
-    y = formant_filter(f3, sample_rate, y, bw)
+  #  The formant filters are cascaded into a single filter (of up to 6th
+  #  order), so that lfilter is only called once.
+  a_coeffs = torch.ones(1, 1, dtype=torch.float64)
+  b_coeffs = torch.ones(1, 1, dtype=torch.float64)
+  for formant in [f1, f2, f3]:
+    if formant > 0:
+      a, b = formant_coefficients(formant, sample_rate, bw)
+      a_coeffs = _poly_mul(a_coeffs, a.unsqueeze(0))
+      b_coeffs = _poly_mul(b_coeffs, b.unsqueeze(0))
+
+  if a_coeffs.shape[-1] > 1:
+    y = lfilter(y, a_coeffs[0], b_coeffs[0], clamp=False)
 
   return y
 
@@ -391,8 +717,9 @@ def glottal_filter(sample_rate, x):
                  torch.tensor([1, 0, 0], dtype=torch.float64), clamp=False)
 
 
-def formant_filter(f, sample_rate, x, bw):
-  """Filter with a formant filter."""
+def formant_coefficients(f, sample_rate,
+                         bw) -> Tuple[torch.Tensor, torch.Tensor]:
+  """Compute the (a, b) coefficients of a formant filter."""
   cft = f/sample_rate
   q = f/bw
   rho = math.exp(-math.pi * cft / q)
@@ -401,6 +728,12 @@ def formant_filter(f, sample_rate, x, bw):
   a3 = rho*rho
   a_coeffs = torch.tensor([1, a2, a3], dtype=torch.float64)
   b_coeffs = torch.tensor([1+a2+a3, 0, 0], dtype=torch.float64)
+  return a_coeffs, b_coeffs
+
+
+def formant_filter(f, sample_rate, x, bw):
+  """Filter with a formant filter."""
+  a_coeffs, b_coeffs = formant_coefficients(f, sample_rate, bw)
   return lfilter(x, a_coeffs, b_coeffs, clamp=False)
 
 
@@ -499,34 +832,70 @@ def correlogram_frame(data: torch.Tensor, pic_width: int,
   if not win_len:
     win_len = data_len
 
-  # Round up to double the window size, and then the next power of 2.
-  fft_size = int(2**(math.ceil(math.log2(2*max(pic_width, win_len)))))
+  fft_size = _correlogram_fft_size(pic_width, win_len)
 
   start = max(0, start)
   last = min(data_len, start+win_len)
 
-  # Generate a window that is win_len long
+  ws = _correlogram_window(win_len, dtype, data.device)
+
+  # The FFT zero-pads the windowed data to fft_size.
+  f = data[..., start:last].to(dtype) * ws[:(last-start)]
+
+  return _correlogram_pic(f, pic_width, fft_size)
+
+
+def _correlogram_fft_size(pic_width: int, win_len: int) -> int:
+  """Round up to double the window size, and then the next power of 2."""
+  return int(2**(math.ceil(math.log2(2*max(pic_width, win_len)))))
+
+
+@functools.lru_cache(maxsize=32)
+def _correlogram_window(win_len: int,
+                        dtype: Optional[torch.dtype] = torch.float64,
+                        device: Optional[torch.device] = None,
+                        ) -> torch.Tensor:
+  """Generate the (Hamming) window that is win_len long.
+
+  Windows are cached, so the returned tensor must not be modified in place.
+  It is always created outside of inference mode, so that it can be saved
+  for backward by later calls on data that requires grad.
+  """
   a = .54
   b = -.46
   wr = math.sqrt(64/256)
   phi = math.pi/win_len
-  ws = 2*wr/math.sqrt(4*a*a+2*b*b)*(
-    a + b*torch.cos(2*math.pi*(torch.arange(win_len, dtype=dtype))/win_len
-                    + phi))
+  with torch.inference_mode(False), torch.no_grad():
+    ws = 2*wr/math.sqrt(4*a*a+2*b*b)*(
+      a + b*torch.cos(2*math.pi*(torch.arange(win_len, dtype=dtype,
+                                              device=device))/win_len
+                      + phi))
+  return ws
+
 
-  # Intialize output
-  output_dimensions =  list(data.shape)
-  output_dimensions[-1] = fft_size
-  f = torch.zeros(output_dimensions, dtype=dtype)
+def _correlogram_pic(f: torch.Tensor, pic_width: int,
+                     fft_size: int) -> torch.Tensor:
+  """Compute normalized autocorrelations of windowed data of size (..., len).
 
-  f[..., :(last-start)] = data[..., start:last] * ws[:(last-start)]
+  All leading dimensions are processed in a single batch of FFTs.
+  """
+  # The data are real, so only half of the spectrum is needed.
   # pylint: disable=not-callable
-  f = torch.fft.fft(f, axis=-1)
+  f = torch.fft.rfft(f, n=fft_size, dim=-1)
   # pylint: disable=not-callable
-  f = torch.fft.ifft(f * torch.conj(f), axis=-1)
+  f = torch.fft.irfft(f * torch.conj(f), n=fft_size, dim=-1)
+
+  return _normalize_pic(f[..., :pic_width])
+
 
+@torch.jit.script
+def _normalize_pic(pic: torch.Tensor) -> torch.Tensor:
+  """Rectify and normalize autocorrelations of size (..., pic_width).
+
+  Scripted so that the pointwise operations can be fused.
+  """
   # Output pic
-  pic = torch.maximum(torch.tensor(0.0), torch.real(f[..., :pic_width]))
+  pic = torch.clamp(pic, min=0.)
 
   # Make sure first column is bigger than the rest
   good_rows = torch.logical_and((pic[..., 0] > 0),
@@ -534,10 +903,12 @@ def correlogram_frame(data: torch.Tensor, pic_width: int,
                                 (pic[..., 0] > pic[..., 2])))
 
   # Define that pic is normalized by sqrt(pic[...,0]). Define further that
-  # zero entries and bad rows are masked out.
-  norm_factor = torch.zeros_like(pic)
-  norm_factor[good_rows] = 1./torch.sqrt(pic[good_rows][...,[0]])
-  pic = pic * norm_factor
+  # zero entries and bad rows are masked out. The inner torch.where keeps the
+  # rsqrt (and its gradient) finite on the bad rows.
+  zero_lag = torch.where(good_rows, pic[..., 0], torch.ones_like(pic[..., 0]))
+  norm_factor = torch.where(good_rows, torch.rsqrt(zero_lag),
+                            torch.zeros_like(zero_lag))
+  pic = pic * norm_factor.unsqueeze(-1)
 
   return pic
 
@@ -576,16 +947,22 @@ def correlogram_array(data: torch.Tensor, sampling_rate: float,
   frame_increment = int(sampling_rate/frame_rate)
   frame_count = int((sample_len-width)/frame_increment) + 1
 
-  movie = []
-  for i in range(frame_count):
-    start = i*frame_increment
-    frame = correlogram_frame(data,
-                              pic_width = width,
-                              start = start,
-                              win_len = frame_increment*4,
-                              dtype = dtype).unsqueeze(-3)
-    movie.append(frame)
-  movie = torch.cat(movie,dim=-3)
+  win_len = frame_increment*4
+  fft_size = _correlogram_fft_size(width, win_len)
+
+  # The last frames may run past the end of the data: zero-pad so that they
+  # are windowed exactly as in correlogram_frame.
+  padded_len = (frame_count-1)*frame_increment + win_len
+  data = torch.nn.functional.pad(data, (0, max(0, padded_len-sample_len)))
+
+  # (..., num_channels, frame_count, win_len) view of all frames, moved to
+  # (..., frame_count, num_channels, win_len).
+  frames = data.unfold(-1, win_len, frame_increment)[..., :frame_count, :]
+  frames = frames.transpose(-2, -3).to(dtype)
+
+  movie = _correlogram_pic(
+      frames * _correlogram_window(win_len, dtype, data.device),
+      width, fft_size)
   return movie
 
 
@@ -653,37 +1030,44 @@ def correlogram_pitch(correlogram: torch.Tensor,
   else:
     drop_high = width
 
-  frames = correlogram.shape[-3]
-
-  pitch = torch.zeros(frames, dtype=dtype)
-  salience = torch.zeros(frames, dtype=dtype)
-  for j in range(frames):
-    # Get one frame from the correlogram and compute
-    # the sum (as a function of time lag) across all channels.
-    summary = torch.sum(correlogram[j, :, :], axis=0)
-    zero_lag = torch.sum(correlogram[j, :, :], axis=0)[0]
-    # Now we need to find the first pitch past the peak at zero
-    # lag.  The following lines smooth the summary pitch a bit, then
-    # look for the first point where the summary goes back up.
-    # Everything up to this point is zeroed out.
-    window_length = 16
-    b_coefs = torch.ones(window_length, dtype=dtype)
-    a_coefs = torch.zeros(window_length, dtype=dtype)
-    a_coefs[0] = 1.
-    sumfilt = lfilter(summary, a_coefs, b_coefs, clamp=False, batching=True)
-
-    sumdif = sumfilt[..., 1:width] - sumfilt[..., :width-1]
-    sumdif[:window_length] = 0
-    valleys = torch.argwhere(sumdif > 0)
-    summary[:int(valleys[0, 0])] = 0
-    summary[1:drop_low] = 0
-    summary[drop_high:] = 0
-
-    # Now find the location of the biggest peak and call this the pitch
-    p = torch.argmax(summary)
-    if p > 0:
-      pitch[j] = sr/float(p)
-
-    salience[j] = summary[p]/zero_lag
+  # Compute the sum (as a function of time lag) across all channels, for all
+  # frames at once.
+  summary = torch.sum(correlogram, dim=-2)
+  # The channel sum is computed only once. Masking below is out of place, so
+  # zero_lag can stay a view of the unmasked summary.
+  zero_lag = summary[..., 0]
+  num_lags = summary.shape[-1]
+
+  # Now we need to find the first pitch past the peak at zero
+  # lag.  The following lines smooth the summary pitch a bit, then
+  # look for the first point where the summary goes back up.
+  # Everything up to this point is zeroed out.
+  # The smoothing is a causal moving sum over window_length lags, computed
+  # as a difference of cumulative sums.
+  window_length = 16
+  csum = torch.nn.functional.pad(torch.cumsum(summary, dim=-1),
+                                 (window_length, 0))
+  sumfilt = csum[..., window_length:] - csum[..., :-window_length]
+
+  sumdif = sumfilt[..., 1:width] - sumfilt[..., :width-1]
+  sumdif[..., :window_length] = 0
+  # Index of the first valley of each frame, found without leaving the
+  # device. argmax returns 0 for frames without a valley, so that nothing
+  # is zeroed out for them.
+  first_valley = (sumdif > 0).int().argmax(dim=-1)
+
+  lags = torch.arange(num_lags, device=summary.device)
+  mask = torch.logical_or(
+      lags < first_valley.unsqueeze(-1),
+      torch.logical_or(torch.logical_and(lags >= 1, lags < drop_low),
+                       lags >= drop_high))
+  summary = summary.masked_fill(mask, 0)
+
+  # Now find the location of the biggest peak and call this the pitch
+  p = torch.argmax(summary, dim=-1)
+  pitch = torch.where(p > 0, sr/p.to(dtype), torch.zeros_like(p, dtype=dtype))
+
+  salience = (torch.gather(summary, -1, p.unsqueeze(-1)).squeeze(-1) /
+              zero_lag).to(dtype)
 
   return pitch, salience
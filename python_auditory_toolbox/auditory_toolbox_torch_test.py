@@ -3,6 +3,7 @@
 import unittest
 import torch
 import torch.fft
+import torchaudio
 import numpy as np
 import auditory_toolbox_torch as pat
 
@@ -45,6 +46,35 @@ class AuditoryToolboxTests(unittest.TestCase):
     self.assertEqual(b2.numpy().shape, (num_chan, 1))
     self.assertEqual(gain.numpy().shape, (num_chan, 1))
 
+    fcoefs32 = pat.make_erb_filters(fs, num_chan, low_freq,
+                                    dtype=torch.float32)
+    for c, c32 in zip(fcoefs, fcoefs32):
+      self.assertEqual(c32.dtype, torch.float32)
+      np.testing.assert_allclose(c32.numpy(), c.numpy(), rtol=1e-6)
+    sos = pat.prepare_coefficients(fcoefs, dtype=torch.float32)
+    self.assertEqual(sos.dtype, torch.float32)
+    self.assertEqual(sos.shape, (num_chan, 3, 5))
+
+
+  def test_make_erb_filters_batched(self):
+    """Test the batched design of several filterbanks."""
+    fs_list = [16000, 22050, 44100]
+    low_freq_list = [100, 60, 100]
+    num_chan = 10
+    sos = pat.make_erb_filters_batched(fs_list, num_chan, low_freq_list)
+    self.assertEqual(sos.shape, (3, num_chan, 3, 5))
+    for i, (fs, low_freq) in enumerate(zip(fs_list, low_freq_list)):
+      expected = pat.prepare_coefficients(
+          pat.make_erb_filters(fs, num_chan, low_freq))
+      np.testing.assert_allclose(sos[i].numpy(), expected.numpy(),
+                                 rtol=1e-12)
+
+    # Filterbanks share a cached design but not their buffers.
+    fbank1 = pat.ErbFilterBank(sampling_rate=16000, num_channels=10)
+    fbank2 = pat.ErbFilterBank(sampling_rate=16000, num_channels=10)
+    np.testing.assert_equal(fbank1.sos.numpy(), fbank2.sos.numpy())
+    fbank1.sos.zero_()
+    self.assertGreater(torch.abs(fbank2.sos).max(), 0)
 
   def test_erb_filterbank_peaks(self):
     """Test peaks."""
@@ -77,6 +107,78 @@ class AuditoryToolboxTests(unittest.TestCase):
     python_out_peak_locs = np.argmax(y.squeeze(), axis=-1)
     self.assertEqual(list(python_out_peak_locs + 1), matlab_out_peak_locs)
 
+  def test_erb_filterbank_modes(self):
+    """Test that the FFT, FIR and IIR implementations agree."""
+    torch.manual_seed(0)
+    x = torch.randn(3, 5000, dtype=torch.float64)
+
+    # A high lowest frequency gives short, quickly decaying impulse responses.
+    for sampling_rate, lowest_frequency in [(16000, 100), (16000, 1000),
+                                            (44100, 2000)]:
+      y = {}
+      for mode in ['fft', 'fir', 'iir']:
+        fbank = pat.ErbFilterBank(sampling_rate=sampling_rate,
+                                  num_channels=10,
+                                  lowest_frequency=lowest_frequency,
+                                  mode=mode)
+        y[mode] = fbank(x).numpy()
+        self.assertEqual(y[mode].shape, (3, 10, 5000))
+
+      # The input is longer than the impulse response, so any energy missing
+      # from the truncated tail shows up in the comparison with the IIR.
+      self.assertLess(fbank.ir_length, 5000)
+      np.testing.assert_allclose(y['fft'], y['iir'], atol=1e-8)
+      np.testing.assert_allclose(y['fir'], y['fft'], atol=1e-10)
+
+    # The impulse responses are recomputed, not stored in checkpoints.
+    self.assertNotIn('impulse_response', fbank.state_dict())
+
+    with self.assertRaises(ValueError):
+      pat.ErbFilterBank(mode='foo')
+
+  def test_erb_filterbank_iir_cascade(self):
+    """Test the IIR filterbank against a plain cascade of biquads."""
+    torch.manual_seed(0)
+    x = torch.randn(2, 20000, dtype=torch.float64)
+    # High sampling rates and low frequencies put the poles closest to the
+    # unit circle.
+    for sampling_rate, lowest_frequency in [(16000, 100), (96000, 20),
+                                            (192000, 20)]:
+      fbank = pat.ErbFilterBank(sampling_rate=sampling_rate,
+                                num_channels=10,
+                                lowest_frequency=lowest_frequency,
+                                mode='iir')
+      y = fbank(x).numpy()
+
+      expected = x.unsqueeze(-2).tile(1, 10, 1)
+      for j in range(4):
+        expected = torchaudio.functional.lfilter(
+            expected, fbank.sos[..., -1], fbank.sos[..., j],
+            clamp=False, batching=True)
+      expected = expected.numpy()
+      np.testing.assert_allclose(y, expected,
+                                 atol=1e-12*np.max(np.abs(expected)))
+
+  @unittest.skipUnless(torch.cuda.is_available() and
+                       pat.triton is not None, 'Needs CUDA and Triton')
+  def test_erb_filterbank_cuda(self):
+    """Test the Triton IIR filterbank against the CPU one."""
+    torch.manual_seed(0)
+    x = torch.randn(2, 3, 2000, dtype=torch.float32)
+    fbank = pat.ErbFilterBank(sampling_rate=16000,
+                              num_channels=10,
+                              lowest_frequency=100,
+                              dtype=torch.float32,
+                              mode='iir')
+    y_cpu = fbank(x)
+    x_cuda = x.cuda().requires_grad_()
+    y_cuda = fbank.cuda()(x_cuda)
+    np.testing.assert_allclose(y_cuda.detach().cpu().numpy(), y_cpu.numpy(),
+                               atol=1e-5)
+
+    y_cuda.sum().backward()
+    self.assertEqual(x_cuda.grad.shape, x.shape)
+
   def test_fm_points(self):
     """Test fm points"""
     base_pitch = 160
@@ -216,6 +318,23 @@ class AuditoryToolboxTests(unittest.TestCase):
 
     self.assertEqual(list(loc+1), [376, 351, 513, 513])
 
+  def test_make_vowel_formant_cascade(self):
+    """Test the fused formant filters against one filter per formant."""
+    sample_rate = 16000
+    impulses = torch.zeros(2000, dtype=torch.float64)
+    impulses[1] = 1.
+    expected = pat.glottal_filter(sample_rate, impulses)
+    for f in [730, 1090, 2440]:
+      expected = pat.formant_filter(f, sample_rate, expected, 50)
+    y = pat.make_vowel(2000, [1,], sample_rate, 'a')
+    np.testing.assert_allclose(y.numpy(), expected.numpy(), atol=1e-10)
+
+  def test_make_vowel_long(self):
+    """Test impulse placement past 32767 samples."""
+    y = pat.make_vowel(40000, [35000.5,], 16000, 'a').numpy()
+    np.testing.assert_equal(y[:35000], 0)
+    self.assertGreater(np.max(np.abs(y[35000:])), 0)
+
   def test_make_vowels_bw(self):
     # Need to write tests.
     pass
@@ -271,6 +390,42 @@ class AuditoryToolboxTests(unittest.TestCase):
                      skip_lags,
                      pitch_lag)
 
+    # The batched correlogram_array should match frame by frame computations
+    frame_rate = 100
+    frame_increment = int(16000/frame_rate)
+    movie = pat.correlogram_array(y, 16000, frame_rate, frame_width)
+    self.assertEqual(movie.shape,
+                     (1, (impulse_len-frame_width)//frame_increment + 1, 64,
+                      frame_width))
+    # The dtype argument sets the output dtype, whatever the input dtype.
+    self.assertEqual(pat.correlogram_frame(y, frame_width,
+                                           dtype=torch.float32).dtype,
+                     torch.float32)
+    self.assertEqual(pat.correlogram_array(y, 16000, frame_rate, frame_width,
+                                           dtype=torch.float32).dtype,
+                     torch.float32)
+    for i in range(movie.shape[1]):
+      frame = pat.correlogram_frame(y, frame_width, i*frame_increment,
+                                    frame_increment*4)
+      np.testing.assert_allclose(movie[:, i].numpy(), frame.numpy(),
+                                 atol=1e-10)
+
+  def test_correlogram_window_cache(self):
+    """Test that a window cached in inference mode still supports autograd."""
+    # Make sure the window is first created (and cached) in inference mode.
+    pat._correlogram_window.cache_clear()  # pylint: disable=protected-access
+    data = torch.rand(1, 4, 2000, dtype=torch.float64)
+    with torch.inference_mode():
+      pat.correlogram_array(data, 1000, 8, 128)
+
+    data.requires_grad_()
+    movie = pat.correlogram_array(data, 1000, 8, 128)
+    movie.sum().backward()
+    self.assertEqual(data.grad.shape, data.shape)
+
+    frame = pat.correlogram_frame(data, 128, 0, 500)
+    frame.sum().backward()
+
   def test_correlogram_pitch(self):
     """Test correlogram_pitch."""
     sample_len = 20000